@@ -1,77 +1,725 @@
-import bertopic
+# heavy dependencies (bertopic, plotly, kaleido, wordcloud, matplotlib and reportlab)
+# are imported by the functions that use them so loading a corpus does not pay for them
 import pandas as pd
-from wordcloud import WordCloud
-import plotly.express as px
-import kaleido
 import rispy
+import re
+import textwrap
 
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.utils import ImageReader
-from reportlab.platypus import Paragraph
 
-import matplotlib.pyplot as plt
-import textwrap
+# RIS fields kept by file_loader and the corpus column names they are renamed to
+RIS_FIELDS = {
+    'doi': 'DOI', 'title': 'Title', 'authors': 'Authors', 'year': 'Year',
+    'secondary_title': 'Source', 'volume': 'Volume', 'start_page': 'Start',
+    'end_page': 'End', 'abstract': 'Abstract', 'notes': 'Citations',
+    'type_of_reference': 'Type'
+}
+
+
+# patterns for the citation count in the notes field of each database's export
+CITATION_PATTERNS = {
+    "scopus": re.compile(r'Cited By:\s*(\d+)'),
+    "wos": re.compile(r'Total Times Cited:\s*(\d+)')
+}
 
 
-def file_loader(ris_file, nbook="colab", source="scopus"):
+def ris_chunks(ris_file, chunk_size=10000):
     '''
-    FUNCTION to load a file from ris format and prepare for a clr analysis
-    INPUT: a RIS format export from an academic database (tested on Scopus and WoS)
-    OUTPUT: a prepared corpus with citations extracted and column names fixed
+    FUNCTION to stream a ris file one record at a time in fixed-size chunks
+    INPUT: a path to a RIS file and the number of records per chunk
+    OUTPUT: a generator of dataframes (one per chunk) holding only the fields in RIS_FIELDS
     '''
-  
-    # adjust path if using a colab notebook
-    if nbook == "colab":
-        if 'content/' not in ris_file:
-            ris_file = '/content/' + ris_file
+
+    parser = rispy.RisParser()
+    buffers = {field: [] for field in RIS_FIELDS} # one column buffer per kept field
 
     with open(ris_file, 'r') as file:
-        entries = rispy.load(file)
+        # parse records lazily rather than building the full list of entries. _yield_lines is
+        # private to rispy (it yields one entry dict at a time in the pinned 0.9.0) so fall back
+        # to loading the whole file if a later rispy drops it
+        entries = parser._yield_lines(file) if hasattr(parser, '_yield_lines') else rispy.load(file)
+        for entry in entries:
+            for field, buffer in buffers.items():
+                buffer.append(entry.get(field))
 
-    temp_df = pd.DataFrame(entries)
+            # flush the buffers once the chunk is full
+            if len(buffers['doi']) == chunk_size:
+                yield pd.DataFrame(buffers)
+                buffers = {field: [] for field in RIS_FIELDS}
+
+    # flush any remaining records
+    if len(buffers['doi']) > 0:
+        yield pd.DataFrame(buffers)
+
+
+def extract_citations(notes, source="scopus"):
+    '''
+    FUNCTION to extract citation counts from the ris notes field
+    INPUT: a series of ris notes (lists of strings) and the database they were exported from
+    OUTPUT: an int32 series of citation counts (0 where the record has no citation note)
+    '''
+
+    if source not in CITATION_PATTERNS:
+        raise ValueError(f"source must be one of {[*CITATION_PATTERNS]}, not {source}")
+
+    # join each record's notes and pull out the count with a single regex pass
+    notes = notes.str.join('\n')
+    counts = notes.str.extract(CITATION_PATTERNS[source], expand=False)
+
+    # records with no count that carry another database's citation note were exported from
+    # that database, so their counts would otherwise be silently set to 0
+    missing = notes[counts.isna()]
+    for other, pattern in CITATION_PATTERNS.items():
+        if other != source and missing.str.extract(pattern, expand=False).notna().any():
+            raise ValueError(f"Records with {other} citation notes were read as {source}. "
+                             f"Pass a source per file to file_loader when merging exports")
+
+    return counts.fillna('0').astype('int32')
+
+
+def prepare_corpus(corpus, source="scopus"):
+    '''
+    FUNCTION to rename the ris fields and extract citations
+    INPUT: a dataframe of ris fields (see RIS_FIELDS) and the database it was exported from
+    OUTPUT: a prepared corpus with citations extracted and column names fixed
+    '''
 
     # filter to just the relevant fields
-    corpus = temp_df[[
-      'doi', 'title', 'authors', 'year', 'secondary_title', 'volume',
-      'start_page', 'end_page', 'abstract', 'notes', 'type_of_reference']]
+    corpus = corpus[[*RIS_FIELDS]]
 
     # rename
-    corpus = corpus.rename(columns={
-      'doi': 'DOI', 'title': 'Title', 'authors': 'Authors', 'year': 'Year',
-      'secondary_title': 'Source', 'volume': 'Volume', 'start_page': 'Start',
-      'end_page': 'End', 'abstract': 'Abstract', 'notes': 'Citations',
-      'type_of_reference': 'Type'
-    })
-
-    # TODO - work out a decent deduplication strategy
-    # drop duplicates based on DOI
-    # corpus = corpus.drop_duplicates(subset='DOI')
+    corpus = corpus.rename(columns=RIS_FIELDS)
 
     # seperate out citations from the text
-    if source == "scopus":
-        corpus['Citations'] = corpus['Citations'].str[0].str.split(';')
-        corpus['Citations'] = corpus['Citations'].str[1].str.replace("Cited By: ", "").astype(int)
-    elif source == "wos":
-        corpus['Citations'] = corpus['Citations'].str[1].str.split(': ')
-        corpus['Citations'] = corpus['Citations'].str[1].astype(int)
+    corpus['Citations'] = extract_citations(corpus['Citations'], source)
 
     # convert numeric columns to a numeric data type
-    num_cols = ['Year', 'Citations']
-    for col in num_cols:
-        corpus[col] = pd.to_numeric(corpus[col])
+    corpus['Year'] = pd.to_numeric(corpus['Year'])
+
+    return corpus
+
+
+def file_hash(ris_file, block_size=1<<20):
+    '''
+    FUNCTION to hash the contents of a file
+    INPUT: a path to a file (and the number of bytes to read at a time)
+    OUTPUT: the sha256 hex digest of the file contents
+    '''
+    import hashlib
+
+    digest = hashlib.sha256()
+    with open(ris_file, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+# dtypes of the prepared corpus emitted by file_loader (Authors is dictionary-encoded by encode_authors)
+CORPUS_SCHEMA = {
+    'Year': 'Int16', 'Citations': 'int32', 'Source': 'category', 'Type': 'category',
+    'Volume': 'category'
+}
+
+
+def encode_authors(authors):
+    '''
+    FUNCTION to dictionary-encode the author lists of a corpus
+    INPUT: a series of author lists (one per paper)
+    OUTPUT: a series backed by a single arrow list array, i.e. an offsets array into an
+    array of author ids plus one shared vocabulary of author names
+    '''
+    import itertools
+    import numpy as np
+    import pyarrow as pa
+
+    # number of authors per paper (papers with no authors get an empty list)
+    lengths = np.fromiter((len(a) if isinstance(a, (list, np.ndarray)) else 0 for a in authors),
+                          dtype=np.int32, count=len(authors))
+    offsets = np.zeros(len(authors) + 1, dtype=np.int32)
+    np.cumsum(lengths, out=offsets[1:])
+
+    # intern the author names and replace them with integer ids
+    flat = np.fromiter(itertools.chain.from_iterable(a for a in authors if isinstance(a, (list, np.ndarray))),
+                       dtype=object, count=offsets[-1])
+    ids, names = pd.factorize(flat)
+    values = pa.DictionaryArray.from_arrays(pa.array(ids, pa.int32()), pa.array(names, pa.string()))
+
+    return pd.Series(pd.arrays.ArrowExtensionArray(pa.ListArray.from_arrays(pa.array(offsets), values)),
+                     index=authors.index, name=authors.name)
+
+
+def compact_corpus(corpus):
+    '''
+    FUNCTION to convert a prepared corpus to the compact CORPUS_SCHEMA
+    INPUT: a prepared corpus
+    OUTPUT: the corpus with categorical, small integer and dictionary-encoded author columns
+    '''
+
+    corpus = corpus.astype(CORPUS_SCHEMA)
+    corpus['Authors'] = encode_authors(corpus['Authors'])
+
+    return corpus
+
+
+def read_corpus(corpus_file):
+    '''
+    FUNCTION to read a corpus saved as parquet (memory-mapped)
+    INPUT: a path to a parquet file written from a compact corpus
+    OUTPUT: the corpus with the CORPUS_SCHEMA dtypes restored
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(corpus_file, memory_map=True)
+
+    # keep the author lists as arrow rather than converting each row to a python object
+    return table.to_pandas(types_mapper=lambda t: pd.ArrowDtype(t) if pa.types.is_list(t) else None)
+
+
+def author_incidence(corpus):
+    '''
+    FUNCTION to build the sparse paper x author incidence matrix from the encoded authors
+    INPUT: a corpus (with Authors encoded by encode_authors, or as lists)
+    OUTPUT: a binary csr matrix (one row per paper, one column per author) and the author names
+    '''
+    import numpy as np
+    import pyarrow as pa
+    from scipy.sparse import csr_matrix
+
+    authors = corpus['Authors']
+    if not isinstance(authors.dtype, pd.ArrowDtype):
+        authors = encode_authors(authors)
+
+    arrow = pa.array(authors.array)
+    chunks = arrow.chunks if isinstance(arrow, pa.ChunkedArray) else [arrow]
+
+    # read the author counts and ids straight from the arrow chunks
+    lengths, ids, names = [np.zeros(0, dtype=np.int32)], [np.zeros(0, dtype=np.int32)], pa.array([], pa.string())
+    for chunk in chunks:
+        lengths.append(chunk.value_lengths().fill_null(0).to_numpy())
+        values = chunk.flatten()
+        if len(names) == 0 or values.dictionary.equals(names):
+            names = values.dictionary
+            ids.append(values.indices.to_numpy())
+        else:
+            # chunks from different corpora have their own vocabularies so merge them
+            codes, uniques = pd.factorize(np.concatenate([names.to_numpy(zero_copy_only=False),
+                                                          values.dictionary.to_numpy(zero_copy_only=False)]))
+            ids = [codes[i] for i in ids] + [codes[len(names):][values.indices.to_numpy()]]
+            names = pa.array(uniques, pa.string())
+
+    indptr = np.zeros(len(authors) + 1, dtype=np.int64)
+    np.cumsum(np.concatenate(lengths), out=indptr[1:])
+    ids = np.concatenate(ids)
+
+    incidence = csr_matrix((np.ones(len(ids), dtype=np.int32), ids, indptr), shape=(len(authors), len(names)))
+    # an author listed twice on the same paper still counts once
+    incidence.sum_duplicates()
+    incidence.data[:] = 1
+
+    return incidence, pd.Index(names.to_numpy(zero_copy_only=False), name='Authors')
+
+
+def memory_footprint(corpus):
+    '''
+    FUNCTION to report the memory used by each column of a corpus
+    INPUT: a corpus
+    OUTPUT: a dataframe of the dtype and size (MB) of each column
+    '''
+
+    return pd.DataFrame({
+        'dtype': corpus.dtypes.astype(str),
+        'MB': corpus.memory_usage(deep=True, index=False) / 1e6
+    })
+
+
+# shortest normalised title (ignoring spaces) that deduplicate will match records on
+TITLE_KEY_MIN_LENGTH = 10
+
+
+def normalise_title(title):
+    '''
+    FUNCTION to normalise a title for matching (unicode form, accents, case, punctuation and spacing)
+    INPUT: a title
+    OUTPUT: the normalised title, or '' if it is too short or mostly digits to match on safely
+    '''
+    import unicodedata
+
+    title = ''.join(char for char in unicodedata.normalize('NFKD', title) if not unicodedata.combining(char))
+    title = re.sub(r'[\W_]+', ' ', title.casefold()).strip()
+
+    # very short or mostly numeric titles (e.g. "Editorial" or "2020") are too generic to block on
+    compact = title.replace(' ', '')
+    letters = sum(char.isalpha() for char in compact)
+    if len(compact) < TITLE_KEY_MIN_LENGTH or letters <= len(compact) / 2:
+        return ''
+
+    return title
+
+
+def deduplicate(corpus):
+    '''
+    FUNCTION to merge duplicate records (e.g. from combined Scopus and WoS exports).
+    Records are matched exactly on a normalised DOI and, where a record has no DOI,
+    on a blocking key of normalised title and year (titles shorter than
+    TITLE_KEY_MIN_LENGTH or mostly digits are not matched). Both are hashed lookups so the
+    cost is linear in the number of records rather than pairwise
+    INPUT: a prepared corpus
+    OUTPUT: the deduplicated corpus (indexed by the kept row) and a dataframe reporting
+    which records were merged into which and how they were matched
+    '''
+    import numpy as np
+
+    corpus = corpus.reset_index(drop=True)
+    n = len(corpus)
+
+    # normalise DOIs (case and any resolver prefix) and index them
+    doi = corpus['DOI'].str.strip().str.lower().str.replace(r'^(https?://)?(dx\.)?doi\.org/', '', regex=True)
+    doi_codes, doi_uniques = pd.factorize(doi.where(doi != ''))
+    has_doi = doi_codes >= 0
+
+    # normalise titles and block on title + year
+    title = corpus['Title'].map(normalise_title, na_action='ignore')
+    title_key = title.where(title != '') + '|' + corpus['Year'].astype(str)
+    title_codes, _ = pd.factorize(title_key)
+    has_title = title_codes >= 0
+
+    # records with a DOI are grouped by DOI
+    group = doi_codes.astype(np.int64)
+
+    # records without a DOI join the DOI group of the first record sharing their title key
+    doi_by_title = pd.Series(doi_codes[has_doi & has_title]).groupby(title_codes[has_doi & has_title]).first()
+    no_doi = ~has_doi & has_title
+    matched = pd.Series(title_codes[no_doi]).map(doi_by_title).to_numpy()
+    # otherwise they are grouped among themselves on title key (offset past the DOI groups)
+    group[no_doi] = np.where(np.isnan(matched), len(doi_uniques) + title_codes[no_doi], matched)
+
+    # records with neither a DOI nor a title are left as they are
+    lonely = ~has_doi & ~has_title
+    group[lonely] = len(doi_uniques) + title_codes.max() + 1 + np.arange(lonely.sum())
+
+    # the first record of each group is kept
+    kept = pd.Series(np.arange(n)).groupby(group).transform('min').to_numpy()
+
+    # merge each group, filling missing fields from the duplicates and keeping the highest citation count
+    deduped = corpus.groupby(group, sort=False).first()
+    deduped['Citations'] = corpus['Citations'].groupby(group, sort=False).max()
+    deduped.index = np.flatnonzero(kept == np.arange(n))
+
+    # report of the dropped records (by row position and by DOI and title)
+    dropped = np.flatnonzero(kept != np.arange(n))
+    merged = pd.DataFrame({
+        'record': dropped, 'DOI': corpus['DOI'].to_numpy()[dropped], 'Title': corpus['Title'].to_numpy()[dropped],
+        'merged_into': kept[dropped], 'merged_into_DOI': corpus['DOI'].to_numpy()[kept[dropped]],
+        'merged_into_Title': corpus['Title'].to_numpy()[kept[dropped]],
+        'match': np.where(has_doi[dropped] & has_doi[kept[dropped]], 'doi', 'title_year')
+    })
+
+    return deduped, merged
+
+
+def load_ris(ris_file, source="scopus", stream=False, chunk_size=10000):
+    '''
+    FUNCTION to parse and prepare a single ris file (run in a worker process by file_loader)
+    INPUT: a path to a RIS file, the database it was exported from and the streaming options
+    OUTPUT: a list of prepared corpus chunks (a single chunk unless stream == True)
+    '''
+
+    if stream:
+        # prepare each chunk as it is parsed
+        return [prepare_corpus(chunk, source) for chunk in ris_chunks(ris_file, chunk_size)]
+
+    with open(ris_file, 'r') as file:
+        entries = rispy.load(file)
+
+    temp_df = pd.DataFrame(entries)
+
+    return [prepare_corpus(temp_df, source)]
+
+
+def file_loader(ris_file, nbook="colab", source="scopus", stream=False, chunk_size=10000,
+                cache=False, cache_dir="clr_cache", n_jobs=None, dedup=False):
+    '''
+    FUNCTION to load a file from ris format and prepare for a clr analysis
+    INPUT: a RIS format export from an academic database (tested on Scopus and WoS), or a
+    list/glob pattern of exports which are parsed in parallel across n_jobs processes
+    (defaults to the number of cores). source is the database the exports came from, either
+    one for all files or, when merging exports from different databases, a list (one per
+    file or pattern) or a dict mapping each file or pattern to its database.
+    If stream == True the file is parsed in chunks of chunk_size records so peak
+    memory scales with the chunk size rather than the size of the export.
+    If cache == True the prepared corpus is stored as parquet in cache_dir (keyed by
+    the file contents and source) and loaded from there on later calls.
+    If dedup == True duplicate records are merged (see deduplicate)
+    OUTPUT: a prepared corpus with citations extracted and column names fixed, using the
+    compact dtypes in CORPUS_SCHEMA. If dedup == True this is returned with a report of each
+    dropped record (its DOI, title and file and those of the record it was merged into)
+    '''
+    import os
+
+    # a single file, a glob pattern or a list of files (as strings or paths)
+    if isinstance(ris_file, (str, os.PathLike)):
+        ris_files = [os.fspath(ris_file)]
+    else:
+        ris_files = [os.fspath(f) for f in ris_file]
+
+    # the database of each file (or pattern)
+    if isinstance(source, str):
+        sources = [source] * len(ris_files)
+    elif isinstance(source, dict):
+        source = {os.fspath(f): s for f, s in source.items()}
+        missing = [f for f in ris_files if f not in source]
+        if len(missing) > 0:
+            raise ValueError(f"No source given for {missing}")
+        sources = [source[f] for f in ris_files]
+    else:
+        sources = list(source)
+        if len(sources) != len(ris_files):
+            raise ValueError(f"Got {len(sources)} sources for {len(ris_files)} files")
+
+    # adjust paths if using a colab notebook
+    if nbook == "colab":
+        ris_files = [f if 'content/' in f else '/content/' + f for f in ris_files]
+        if 'content/' not in cache_dir:
+            cache_dir = '/content/' + cache_dir
+
+    # expand any glob patterns (each match takes the source of its pattern)
+    if any(char in f for f in ris_files for char in '*?['):
+        import glob
+        matches = sorted((path, s) for f, s in zip(ris_files, sources) for path in glob.glob(f))
+        if len(matches) == 0:
+            raise FileNotFoundError(f"No RIS files match {ris_file}")
+        ris_files, sources = [path for path, _ in matches], [s for _, s in matches]
+
+    # return the cached corpus if these files have been prepared before
+    if cache:
+        import hashlib
+        if len(ris_files) == 1:
+            key = file_hash(ris_files[0])
+        else:
+            key = hashlib.sha256(''.join(file_hash(f) for f in ris_files).encode()).hexdigest()
+        if len(set(sources)) > 1:
+            key = hashlib.sha256((key + ''.join(sources)).encode()).hexdigest()
+        if dedup:
+            key += '_dedup'
+        source_name = sources[0] if len(set(sources)) == 1 else 'mixed'
+        cache_file = os.path.join(cache_dir, key + '_' + source_name + '.parquet')
+        # the merge report is stored next to the corpus
+        merged_file = cache_file.replace('.parquet', '_merged.parquet')
+        if os.path.isfile(cache_file):
+            if dedup and os.path.isfile(merged_file):
+                return read_corpus(cache_file), pd.read_parquet(merged_file)
+            elif not dedup:
+                return read_corpus(cache_file)
+
+    if len(ris_files) == 1:
+        file_chunks = [load_ris(ris_files[0], sources[0], stream, chunk_size)]
+    else:
+        # parse the files concurrently, one file per worker process
+        from concurrent.futures import ProcessPoolExecutor
+        from functools import partial
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            worker = partial(load_ris, stream=stream, chunk_size=chunk_size)
+            file_chunks = list(pool.map(worker, ris_files, sources))
+
+    # combine all of the chunks once at the end
+    corpus = pd.concat([chunk for chunks in file_chunks for chunk in chunks], ignore_index=True)
+
+    # merge duplicate records
+    if dedup:
+        import numpy as np
+
+        corpus, merged = deduplicate(corpus)
+        corpus = corpus.reset_index(drop=True)
+        print(f"Merged {len(merged)} duplicate records ({(merged['match'] == 'doi').sum()} by DOI, "
+              f"{(merged['match'] == 'title_year').sum()} by title and year)")
+
+        # name the file of each record rather than its position in the combined exports
+        record_files = np.repeat(ris_files, [sum(len(chunk) for chunk in chunks) for chunks in file_chunks])
+        merged.insert(3, 'File', record_files[merged['record']])
+        merged['merged_into_File'] = record_files[merged['merged_into']]
+        merged = merged.drop(columns=['record', 'merged_into'])[
+            ['DOI', 'Title', 'File', 'merged_into_DOI', 'merged_into_Title', 'merged_into_File', 'match']]
+
+    # convert to the compact schema
+    corpus = compact_corpus(corpus)
+    print(f"Corpus memory footprint: {memory_footprint(corpus)['MB'].sum():.1f} MB")
+
+    # write the prepared corpus to the cache (via a temporary file so a failed write is never read back)
+    if cache:
+        os.makedirs(cache_dir, exist_ok=True)
+        if dedup:
+            merged.to_parquet(merged_file, index=False)
+        corpus.to_parquet(cache_file + '.tmp', index=False)
+        os.replace(cache_file + '.tmp', cache_file)
+
+    if dedup:
+        return corpus, merged
 
     return corpus
 
 
-def corpus_eda(file, viz="all", save=True, nbook="colab"):
+def h_index(groups, citations, n_groups=None):
+    '''
+    FUNCTION to calculate the h-index of every group (e.g. author or source) at once
+    INPUT: an array of integer group codes and an array of citations (one entry per paper
+    in the group) and optionally the number of groups
+    OUTPUT: an array of the h-index of each group
+    '''
+    import numpy as np
+
+    groups = np.asarray(groups)
+    citations = np.asarray(citations)
+    if n_groups is None:
+        n_groups = groups.max() + 1 if len(groups) > 0 else 0
+
+    # sort by group and then by citations (most cited first)
+    order = np.lexsort((-citations, groups))
+    groups, citations = groups[order], citations[order]
+
+    # rank of each paper within its group (1 for the most cited)
+    starts = np.searchsorted(groups, groups, side='left')
+    rank = np.arange(1, len(groups) + 1) - starts
+
+    # the h-index is the largest rank with at least that many citations; citations fall as
+    # rank rises so the papers that qualify are a prefix of the group and can just be counted
+    return np.bincount(groups[citations >= rank], minlength=n_groups)
+
+
+def group_codes(file, dimension):
+    '''
+    FUNCTION to factorise a corpus column into integer group codes
+    INPUT: a corpus and the column to group by (e.g. Year, Source or Authors)
+    OUTPUT: the group code and row number of every paper-group pair and the group names
+    '''
+    import numpy as np
+
+    # authors come straight from the paper x author incidence matrix
+    if dimension == "Authors":
+        incidence, names = author_incidence(file)
+        papers, codes = incidence.nonzero()
+        return codes, papers, names
+
+    # papers missing the column are left out
+    codes, names = pd.factorize(file[dimension], sort=True)
+    papers = np.flatnonzero(codes >= 0)
+
+    return codes[papers], papers, pd.Index(np.asarray(names), name=dimension)
+
+
+def group_stats(codes, citations, n_groups):
+    '''
+    FUNCTION to aggregate the citations of every group at once
+    INPUT: the group code and citations of every paper-group pair and the number of groups
+    OUTPUT: a dataframe of the publications, total, mean and max citations and h-index of each group
+    '''
+    import numpy as np
+
+    counts = np.bincount(codes, minlength=n_groups)
+    sums = np.bincount(codes, weights=citations, minlength=n_groups).astype(np.int64)
+    maxes = np.zeros(n_groups, dtype=citations.dtype)
+    np.maximum.at(maxes, codes, citations)
+
+    with np.errstate(invalid='ignore'):
+        means = sums / counts
+
+    return pd.DataFrame({
+        "Publications": counts, "Citations": sums, "Mean Citations": means,
+        "Max Citations": maxes, "h-index": h_index(codes, citations, n_groups)
+    })
+
+
+def eda_state(file, dimensions=("Year", "Source", "Authors")):
+    '''
+    FUNCTION to build the state behind the corpus_eda charts, factorising each column once
+    and aggregating over the integer codes. The state can be updated as records are added
+    (see update_eda_state) and saved with pd.to_pickle
+    INPUT: a corpus and the columns to aggregate by
+    OUTPUT: a dictionary holding the top 100 papers by citations and, for each column, the group
+    names, the group code and citations of every paper-group pair and the group_stats table
+    '''
+
+    citations = file["Citations"].to_numpy()
+
+    state = {"top_papers": file.sort_values(by=['Citations'], ascending=False)[:100]}
+    for dimension in dimensions:
+        codes, papers, names = group_codes(file, dimension)
+        state[dimension] = {
+            "names": names, "codes": codes, "citations": citations[papers],
+            "stats": group_stats(codes, citations[papers], len(names))
+        }
+
+    return state
+
+
+def update_eda_state(state, new_rows):
+    '''
+    FUNCTION to update an eda state with records appended to the corpus. Only the new records
+    are factorised and aggregated and only the groups they touch have their h-index recomputed
+    INPUT: a state from eda_state (or a previous update) and a corpus of the new records
+    OUTPUT: the updated state
+    '''
+    import numpy as np
+
+    citations = new_rows["Citations"].to_numpy()
+
+    top_papers = pd.concat([state["top_papers"], new_rows])
+    new_state = {"top_papers": top_papers.sort_values(by=['Citations'], ascending=False)[:100]}
+
+    for dimension in [key for key in state if key != "top_papers"]:
+        old = state[dimension]
+        codes, papers, names = group_codes(new_rows, dimension)
+
+        # map the groups of the new records onto the existing ones, adding unseen groups at the end
+        lookup = old["names"].get_indexer(names)
+        unseen = lookup < 0
+        lookup[unseen] = len(old["names"]) + np.arange(unseen.sum())
+        all_names = old["names"].append(names[unseen])
+        codes, new_cites = lookup[codes], citations[papers]
+        n_groups = len(all_names)
+
+        # add the new papers to the running counts, sums and maxima
+        stats = old["stats"].reindex(range(n_groups), fill_value=0)
+        stats["Publications"] += np.bincount(codes, minlength=n_groups)
+        stats["Citations"] += np.bincount(codes, weights=new_cites, minlength=n_groups).astype(np.int64)
+        maxes = stats["Max Citations"].to_numpy().copy()
+        np.maximum.at(maxes, codes, new_cites)
+        stats["Max Citations"] = maxes
+        with np.errstate(invalid='ignore'):
+            stats["Mean Citations"] = stats["Citations"] / stats["Publications"]
+
+        all_codes = np.concatenate([old["codes"], codes])
+        all_cites = np.concatenate([old["citations"], new_cites])
+
+        # the h-index can only change (and only rise) for groups with new papers, so just the papers
+        # of those groups cited at least as often as the old h-index need to be ranked again
+        touched = np.unique(codes)
+        old_h = stats["h-index"].to_numpy()
+        rerank = np.isin(all_codes, touched) & (all_cites >= old_h[all_codes])
+        stats.loc[touched, "h-index"] = h_index(np.searchsorted(touched, all_codes[rerank]),
+                                                all_cites[rerank], len(touched))
+
+        new_state[dimension] = {"names": all_names, "codes": all_codes, "citations": all_cites, "stats": stats}
+
+    return new_state
+
+
+def eda_tables(state):
+    '''
+    FUNCTION to extract the aggregate tables from an eda state
+    INPUT: a state from eda_state or update_eda_state
+    OUTPUT: a dictionary (keyed by column) of dataframes with one row per group (see group_stats)
+    '''
+
+    tables = {}
+    for dimension in [key for key in state if key != "top_papers"]:
+        stats = state[dimension]["stats"].copy()
+        stats.insert(0, dimension, state[dimension]["names"])
+        # drop groups without papers (e.g. authors only found in a larger corpus)
+        tables[dimension] = stats[stats["Publications"] > 0].reset_index(drop=True)
+
+    return tables
+
+
+# artefacts that can be requested from corpus_eda and topic_outputs (via viz)
+EDA_ARTEFACTS = [
+    "pubs_by_year", "cites_by_year", "top_paper_cites", "top_author_cites",
+    "top_author_hindex", "top_source_cites", "top_source_hindex"
+]
+TOPIC_ARTEFACTS = ["distance_map", "topic_bar", "similarity_matrix", "topics_df", "topic_report"]
+
+# the column each aggregated eda artefact is grouped by
+EDA_DIMENSIONS = {
+    "pubs_by_year": "Year", "cites_by_year": "Year", "top_author_cites": "Authors",
+    "top_author_hindex": "Authors", "top_source_cites": "Source", "top_source_hindex": "Source"
+}
+
+
+def select_artefacts(viz, artefacts):
+    '''
+    FUNCTION to resolve the viz argument against a list of available artefacts
+    INPUT: "all", a single artefact name or a list of names and the available artefacts
+    OUTPUT: the set of artefact names to produce
+    '''
+
+    if viz == "all":
+        return set(artefacts)
+
+    selected = {viz} if isinstance(viz, str) else set(viz)
+
+    unknown = selected - set(artefacts)
+    if unknown:
+        raise ValueError(f"Unknown viz {sorted(unknown)}, choose from {artefacts} or 'all'")
+
+    return selected
+
+
+def export_outputs(figures, tables, n_renderers=1, n_jobs=1):
+    '''
+    FUNCTION to write figures (png and html) and tables (csv) to the working directory.
+    By default every file is written in turn, which is fastest for the light eda charts. With
+    n_jobs > 1 static images are rendered by n_renderers long-lived kaleido processes (the
+    first is plotly's own) alongside the csv writes on a thread pool of n_jobs threads, which
+    only pays off for heavy figures such as a large topic heatmap
+    INPUT: a dictionary of figures and a dictionary of dataframes keyed by output file name
+    (without extension), the number of image renderers and the number of threads
+    OUTPUT: none - returns once every file has been written
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    import plotly.io as pio
+
+    # html is written from this thread first - plotly loads its json serialiser on first use,
+    # which is not safe from several threads at once (the renderers use it too)
+    for name, fig in figures.items():
+        fig.write_html(name + ".html")
+
+    if n_jobs == 1:
+        for name, fig in figures.items():
+            fig.write_image(name + ".png")
+        for name, table in tables.items():
+            table.to_csv(name + ".csv", index=False)
+        return
+
+    from kaleido.scopes.plotly import PlotlyScope
+
+    # plotly's shared renderer plus any extra renderers (with the same settings)
+    renderers = [pio.kaleido.scope] + [
+        PlotlyScope(plotlyjs=pio.kaleido.scope.plotlyjs, mathjax=pio.kaleido.scope.mathjax)
+        for _ in range(min(n_renderers, len(figures)) - 1)]
+
+    # each renderer handles its share of the figures in turn
+    def render(renderer, names):
+        for name in names:
+            with open(name + ".png", "wb") as out_file:
+                out_file.write(renderer.transform(figures[name], format="png"))
+
+    names = [*figures]
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        futures = [pool.submit(render, renderer, names[i::len(renderers)]) for i, renderer in enumerate(renderers)]
+        futures += [pool.submit(table.to_csv, name + ".csv", index=False) for name, table in tables.items()]
+
+        # wait for every file (and raise any error from the writers)
+        for future in futures:
+            future.result()
+
+
+def corpus_eda(file, viz="all", save=True, nbook="colab", state=None, export_jobs=1, n_renderers=1):
     '''
     FUNCTION to produce eda/visualisations of the data input
-    INPUT: a corpus generated by the file_loader function (from ris)
+    INPUT: a corpus generated by the file_loader function (from ris) and the
+    visualisation(s) to produce ("all", one name or a list of names from EDA_ARTEFACTS).
+    If a state from eda_state/update_eda_state is given the charts are drawn from it
+    and the corpus is not needed (file can be None). export_jobs and n_renderers set the
+    threads and image renderers used to write the outputs (see export_outputs)
     OUTPUT: a dictionary of visualisations and, (if save == True)
     a folder of all the visualisations
     '''
 
+    import plotly.express as px
+
+    # only the requested artefacts are computed
+    selected = select_artefacts(viz, EDA_ARTEFACTS)
+
     # if colab then create folders based on the colab directory structure
     if nbook == "colab" and save:
         import os
@@ -93,39 +741,37 @@ def corpus_eda(file, viz="all", save=True, nbook="colab"):
         os.chdir("/eda")
 
     return_dict = {} # empty dictionary to return visualisation
+    tables = {} # tables to save alongside the visualisations
+
+    # aggregate tables for every column needed by the selected artefacts
+    if state is None:
+        state = eda_state(file, sorted({EDA_DIMENSIONS[name] for name in selected if name in EDA_DIMENSIONS}))
+    aggregates = eda_tables(state)
 
     # Publications by Year
-    if viz == "all" or "pubs_by_year":
-        tempdf = file.groupby(["Year"]).size().to_frame(name = "Publications").reset_index()
+    if "pubs_by_year" in selected:
+        tempdf = aggregates["Year"][["Year", "Publications"]]
         tempdf = tempdf.sort_values(by="Year")
         fig = px.line(tempdf, x="Year", y="Publications", title="Publications by Year")
         fig.update_xaxes(type="category")
 
         return_dict["pubs_by_year"] = fig
-
-        if save:
-            fig.write_html("pubs_by_year.html")
-            fig.write_image("pubs_by_year.png")
-            tempdf.to_csv("pubs_by_year.csv", index=False)
+        tables["pubs_by_year"] = tempdf
 
     # Citations by Year
-    if viz == "all" or "cites_by_year":
-        tempdf = file["Citations"].groupby(file["Year"]).mean().to_frame(name = "Citations").reset_index()
+    if "cites_by_year" in selected:
+        tempdf = aggregates["Year"][["Year", "Mean Citations"]].rename(columns={"Mean Citations": "Citations"})
         tempdf = tempdf.sort_values(by="Year")
         fig = px.line(tempdf, x="Year", y="Citations", title="Average Citations by Year")
         fig.update_xaxes(type="category")
 
         return_dict["cites_by_year"] = fig
-    
-        if save:
-            fig.write_html("cites_by_year.html")
-            fig.write_image("cites_by_year.png")
-            tempdf.to_csv("cites_by_year.csv", index=False)
+        tables["cites_by_year"] = tempdf
 
     # Top papers by citations
-    if viz == "all" or "top_paper_cites":
-        tempdf = file.sort_values(by=['Citations'], ascending=False) # sort by "Citations"
-        tempdf_sset = tempdf[:20] # extract just the top 20 rows
+    if "top_paper_cites" in selected:
+        tempdf = state["top_papers"] # sorted by "Citations"
+        tempdf_sset = tempdf[:20].copy() # extract just the top 20 rows
         tempdf_sset["Title"] = tempdf_sset.Title.str[0:50] + "  "
         tempdf_sset["Year"] = tempdf_sset.Year.astype(str)
         fig = px.bar(tempdf_sset, x="Citations", y="Title", color="Year",
@@ -134,21 +780,12 @@ def corpus_eda(file, viz="all", save=True, nbook="colab"):
         fig.update_layout(yaxis={'categoryorder':'total ascending'})
 
         return_dict["top_paper_cites"] = fig
-    
-        if save:
-            fig.write_html("top_paper_cites.html")
-            fig.write_image("top_paper_cites.png")
-            tempdf[:100].to_csv("top_paper_cites.csv", index=False) # return top 100
+        tables["top_paper_cites"] = tempdf[:100]
 
     # Top authors by citation
-    if viz == "all" or "top_author_cites":
-        authors = file[['Authors', "Citations"]]
- 
-        # explode the data to one row per author per paper
-        authors = authors.explode('Authors')
-
-        # sum up the number of citations per author and rename column
-        tempdf = authors.groupby(['Authors']).sum().reset_index()
+    if "top_author_cites" in selected:
+        # citations summed per author
+        tempdf = aggregates["Authors"][["Authors", "Citations"]]
         tempdf = tempdf.sort_values(by=['Citations'], ascending=False)
 
         # as above, sort the data by citations, select the top 20 and print/save the figure
@@ -160,27 +797,12 @@ def corpus_eda(file, viz="all", save=True, nbook="colab"):
         fig.update_layout(yaxis={'categoryorder':'total ascending'})
 
         return_dict["top_author_cites"] = fig
-    
-        if save:
-            fig.write_html("top_author_cites.html")
-            fig.write_image("top_author_cites.png")
-            tempdf[:100].to_csv("top_author_cites.csv", index=False)
+        tables["top_author_cites"] = tempdf[:100]
 
     # Top authors by h-index
-    if viz == "all" or "top_author_hindex":
-        # subset the file based on authors
-        authors = file[['Authors', "Citations"]]
-
-        # explode the data to one row per author per paper
-        authors = authors.explode('Authors')
-
-        # calculate h-index from the "exploded" (one row per author) dataframe
-        authors['h-index'] = authors.groupby("Authors")["Citations"].transform( lambda x: (x >= x.count()).sum() )
-
-        # reduce the dataframe to one row per author
-        tempdf = authors.groupby(["Authors"]).max().reset_index()
-
-        # sum up the number of citations per author and rename column
+    if "top_author_hindex" in selected:
+        # h-index per author alongside their most cited paper
+        tempdf = aggregates["Authors"][["Authors", "Max Citations", "h-index"]].rename(columns={"Max Citations": "Citations"})
         tempdf = tempdf.sort_values(by=["h-index"], ascending=False)
 
         # as above, sort the data by citations, select the top 20 and print/save the figure
@@ -192,18 +814,12 @@ def corpus_eda(file, viz="all", save=True, nbook="colab"):
         fig.update_layout(yaxis={'categoryorder':'total ascending'})
 
         return_dict["top_author_hindex"] = fig
-    
-        if save:
-            fig.write_html("top_author_hindex.html")
-            fig.write_image("top_author_hindex.png")
-            tempdf[:100].to_csv("top_author_hindex.csv", index=False)
+        tables["top_author_hindex"] = tempdf[:100]
 
     # Top sources by citation
-    if viz == "all" or "top_sources_cites":
-        sources = file[["Source", "Citations"]]
-
-        # sum up the number of citations per author and rename column
-        tempdf = sources.groupby(["Source"]).sum().reset_index()
+    if "top_source_cites" in selected:
+        # citations summed per source
+        tempdf = aggregates["Source"][["Source", "Citations"]]
         tempdf = tempdf.sort_values(by=['Citations'], ascending=False)
 
         # as above, sort the data by citations, select the top 20 and print/save the figure
@@ -217,23 +833,12 @@ def corpus_eda(file, viz="all", save=True, nbook="colab"):
         fig.update_layout(yaxis={'categoryorder':'total ascending'})
 
         return_dict["top_source_cites"] = fig
-    
-        if save:
-            fig.write_html("top_source_cites.html")
-            fig.write_image("top_source_cites.png")
-            tempdf[:100].to_csv("top_source_cites.csv", index=False)
+        tables["top_source_cites"] = tempdf[:100]
 
     # Top journals by h-index
-    if viz == "all" or "top_source_hindex":
-        # subset the file based on sources
-        sources = file[["Source", "Citations"]]
-
-        # calculate h-index
-        sources['h-index'] = sources.groupby('Source')['Citations'].transform( lambda x: (x >= x.count()).sum() )
-
-        tempdf = sources.groupby(['Source']).max().reset_index()
-
-        # sum up the number of citations per author and rename column
+    if "top_source_hindex" in selected:
+        # h-index per source alongside its most cited paper
+        tempdf = aggregates["Source"][["Source", "Max Citations", "h-index"]].rename(columns={"Max Citations": "Citations"})
         tempdf = tempdf.sort_values(by=["h-index"], ascending=False)
 
         # sort the data by citations & select the top 20
@@ -247,12 +852,11 @@ def corpus_eda(file, viz="all", save=True, nbook="colab"):
         fig.update_layout(yaxis={'categoryorder':'total ascending'})
 
         return_dict["top_source_hindex"] = fig
-    
-        if save:
-            fig.write_html("top_source_hindex.html")
-            fig.write_image("top_source_hindex.png")
-            tempdf[:100].to_csv("top_source_hindex.csv", index=False)
+        tables["top_source_hindex"] = tempdf[:100]
 
+    # write all of the visualisations and tables together
+    if save:
+        export_outputs(return_dict, tables, n_renderers=n_renderers, n_jobs=export_jobs)
 
     return return_dict
 
@@ -269,83 +873,991 @@ def hyperP_scaler(corpus):
     return topic_size, umap_size
 
 
-def topic_model(corpus, embed_model="miniLM", rep_model="keybert", n_topics="auto", seed=123):
+def fit_memory(n_docs, embed_dim, n_neighbors, min_samples, low_memory=True, pre_reduce=None):
+    '''
+    FUNCTION to predict the peak memory of fitting a topic model (on top of the libraries).
+    The UMAP, HDBSCAN and c-TF-IDF terms were measured on umap-learn 0.5 with pynndescent
+    0.5.13 (0.6 uses less) and 180 token abstracts, and the total checked against full fits
+    INPUT: the number of documents, the embedding size, UMAP's n_neighbors, HDBSCAN's
+    min_samples, UMAP's low_memory mode and the PCA pre-reduction (None for none)
+    OUTPUT: the predicted peak memory in GB
+    '''
+    embeddings = n_docs * embed_dim * 4
+    umap_dim = embed_dim
+    pca = 0
+    if pre_reduce:
+        # pca centres a copy of the embeddings and keeps the reduced ones
+        pca = n_docs * embed_dim * 4
+        embeddings += n_docs * pre_reduce * 4
+        umap_dim = pre_reduce
+
+    # nearest neighbour search and graph (low_memory=False keeps candidate sets as well)
+    umap = n_docs * (6000 + 52 * n_neighbors + 2.6 * umap_dim + (0 if low_memory else 55 * n_neighbors))
+    # core distances from each document's min_samples nearest neighbours
+    hdbscan = 32 * n_docs * min_samples
+    ctfidf = 1800 * n_docs
+
+    # allocator overhead, plus numba compiling umap and hdbscan on the first fit
+    return (embeddings + 1.15 * (max(pca, umap, hdbscan) + ctfidf)) / 2**30 + 0.4
+
+
+def resource_plan(corpus, memory_budget, embed_dim=384):
+    '''
+    FUNCTION to plan a topic model fit within a memory budget. The hyperP_scaler settings are
+    used if they fit, otherwise cheaper settings are tried in turn - UMAP's low_memory mode,
+    fewer HDBSCAN min_samples, PCA pre-reduction to 100 then 50 dimensions and fewer UMAP
+    neighbours. Corpora over 100k documents also get fewer UMAP epochs (the run time grows
+    with each), smaller ones keep UMAP's default (None)
+    INPUT: a corpus, the memory available for the fit in GB and the embedding size
+    OUTPUT: a dictionary of min_topic_size, n_neighbors, n_epochs, low_memory, min_samples,
+    pre_reduce and the predicted peak_memory_gb (from fit_memory)
+    '''
+    n_docs = len(corpus)
+    min_topics, n_umap = hyperP_scaler(corpus)
+
+    plan = {"min_topic_size": min_topics, "n_neighbors": n_umap,
+            "n_epochs": None if n_docs <= 100000 else max(50, int(200 * 100000 / n_docs)),
+            "low_memory": False, "min_samples": min_topics, "pre_reduce": None}
+
+    # each step is cheaper than the last
+    steps = [{}, {"low_memory": True}, {"min_samples": min(min_topics, 50)}]
+    steps += [{"pre_reduce": dims} for dims in (100, 50) if dims < embed_dim]
+    n_neighbors = n_umap
+    while n_neighbors > 15:
+        n_neighbors = max(n_neighbors // 2, 15)
+        steps.append({"n_neighbors": n_neighbors})
+
+    for step in steps:
+        plan.update(step)
+        plan["peak_memory_gb"] = fit_memory(n_docs, embed_dim, plan["n_neighbors"], plan["min_samples"],
+                                            plan["low_memory"], plan["pre_reduce"])
+        if plan["peak_memory_gb"] <= memory_budget:
+            break
+    else:
+        print(f"No plan fits in {memory_budget} GB, using the smallest")
+
+    print(f"Planned fit for {n_docs} documents: n_neighbors {plan['n_neighbors']}, n_epochs {plan['n_epochs'] or 'default'}, "
+          f"low_memory {plan['low_memory']}, min_samples {plan['min_samples']}, pre_reduce {plan['pre_reduce']} - "
+          f"predicted peak memory {plan['peak_memory_gb']:.1f} GB (budget {memory_budget} GB)")
+
+    return plan
+
+
+# short names for the embedding models (specter as a model pretrained on academic abstracts)
+EMBED_MODELS = {"miniLM": "all-MiniLM-L6-v2", "specter": "allenai-specter"}
+EMBED_BACKENDS = ["torch", "onnx", "int8"]
+# how topic_model trades repeatable results for speed
+EXECUTION_MODES = ["reproducible", "fast"]
+
+
+def load_encoder(embed_model, embed_backend="torch"):
+    '''
+    FUNCTION to load a sentence transformer on a given CPU backend
+    INPUT: a model name (a short name in EMBED_MODELS or any SentenceTransformer name) and the
+    backend - "torch" (full precision PyTorch), "onnx" (ONNX Runtime, needs optimum[onnxruntime]
+    and sentence-transformers 3.2 or later) or "int8" (PyTorch with linear layers dynamically
+    quantised to int8)
+    OUTPUT: a SentenceTransformer model
+    '''
+    from sentence_transformers import SentenceTransformer
+
+    name = EMBED_MODELS.get(embed_model, embed_model)
+
+    if embed_backend == "torch":
+        return SentenceTransformer(name)
+    elif embed_backend == "onnx":
+        import inspect
+
+        # the backend argument arrived in sentence-transformers 3.2
+        if "backend" not in inspect.signature(SentenceTransformer.__init__).parameters:
+            raise ImportError("embed_backend 'onnx' needs sentence-transformers 3.2 or later")
+        return SentenceTransformer(name, device="cpu", backend="onnx")
+    elif embed_backend == "int8":
+        import torch
+
+        encoder = SentenceTransformer(name, device="cpu")
+        return torch.quantization.quantize_dynamic(encoder, {torch.nn.Linear}, dtype=torch.qint8)
+    else:
+        raise ValueError(f"Unknown embed_backend '{embed_backend}', expected one of {EMBED_BACKENDS}")
+
+
+# models loaded by topic_model, kept so repeated calls (e.g. parameter sweeps) reuse them
+MODEL_REGISTRY = {}
+
+
+def registered_model(key, load):
+    '''
+    FUNCTION to return a model from MODEL_REGISTRY, loading it on first use
+    INPUT: a key naming the model and a function (with no arguments) that loads it
+    OUTPUT: the loaded model (shared between all callers using the same key)
+    '''
+    if key not in MODEL_REGISTRY:
+        MODEL_REGISTRY[key] = load()
+
+    return MODEL_REGISTRY[key]
+
+
+def evict_models(model=None):
+    '''
+    FUNCTION to drop models from MODEL_REGISTRY to free their memory
+    INPUT: a model name (a short name in EMBED_MODELS, a SentenceTransformer name or a
+    representation model such as "keybert"), or None to drop every model
+    OUTPUT: a list of the keys dropped
+    '''
+    import gc
+
+    names = {model, EMBED_MODELS.get(model, model)}
+    evicted = [key for key in MODEL_REGISTRY if model is None or key[1] in names]
+    for key in evicted:
+        del MODEL_REGISTRY[key]
+
+    # topic models built before eviction still hold a reference until they are deleted
+    gc.collect()
+
+    return evicted
+
+
+def check_embed_backend(encoder, reference, texts, tolerance=0.01):
+    '''
+    FUNCTION to check an encoder against the full precision model it was derived from
+    INPUT: the encoder, the full precision SentenceTransformer, a sample of texts and the
+    largest allowed drop in cosine similarity (1 - cosine) between their embeddings
+    OUTPUT: the lowest cosine similarity (raises a ValueError if outside the tolerance)
+    '''
+    embeddings = encoder.encode(texts, normalize_embeddings=True)
+    expected = reference.encode(texts, normalize_embeddings=True)
+    cosine = (embeddings * expected).sum(axis=1)
+    print(f"Embedding backend cosine similarity to fp32: min {cosine.min():.4f}, mean {cosine.mean():.4f}")
+
+    if 1 - cosine.min() > tolerance:
+        raise ValueError(f"Embeddings drift from the fp32 model by up to {1 - cosine.min():.4f} "
+                         f"(tolerance {tolerance}), use embed_backend='torch'")
+
+    return cosine.min()
+
+
+def pre_reduction(umap_model, n_components, seed=None):
+    '''
+    FUNCTION to put a linear reduction (PCA) in front of UMAP, so UMAP's nearest neighbour
+    search and memory scale with n_components rather than the embedding size
+    INPUT: a UMAP model, the number of dimensions to reduce the embeddings to and a seed
+    OUTPUT: a pipeline used by BERTopic in place of the UMAP model
+    '''
+    from sklearn.decomposition import PCA
+    from sklearn.pipeline import Pipeline
+
+    # covariance_eigh projects the training embeddings exactly as transform does later, so
+    # UMAP recognises them when BERTopic transforms them after fitting (rather than
+    # re-embedding the whole corpus)
+    return Pipeline([("pca", PCA(n_components=n_components, svd_solver="covariance_eigh", random_state=seed)),
+                     ("umap", umap_model)])
+
+
+def topic_model(corpus, embed_model="miniLM", rep_model="keybert", n_topics="auto", seed=123,
+                embed_backend="torch", backend_tolerance=0.01, pre_reduce=None, memory_budget=None,
+                mode=None):
     '''
     FUNCTION to specify the neural topic model
-    INPUT: a corpus and set of hyperparameters
+    INPUT: a corpus and set of hyperparameters. embed_backend runs the embedding model on
+    "torch", "onnx" or "int8" (see load_encoder) - the faster backends are checked against
+    the fp32 model on a sample of abstracts and must stay within backend_tolerance. The
+    embedding and representation models are loaded once and reused by later calls (see
+    MODEL_REGISTRY, evict_models frees them). pre_reduce (e.g. 50-100) reduces the embeddings
+    to that many dimensions with PCA before UMAP (see pre_reduction). memory_budget (GB of
+    memory available for the fit, with n_topics='auto') picks the UMAP and HDBSCAN settings with
+    resource_plan. mode is "reproducible" (UMAP seeded with seed, which keeps it to a single
+    thread) or "fast" (unseeded, so UMAP runs on every core) - by default reproducible unless
+    seed is None
     OUTPUT: a specified topic model 
     '''
+    from functools import partial
+    import bertopic
+    from hdbscan import HDBSCAN
+    from umap import UMAP
+
+    if mode is None:
+        mode = "fast" if seed is None else "reproducible"
+    if mode not in EXECUTION_MODES:
+        raise ValueError(f"Unknown mode {mode}, expected one of {EXECUTION_MODES}")
+    if mode == "reproducible" and seed is None:
+        raise ValueError("The reproducible mode needs a seed")
+    if memory_budget is not None and n_topics != "auto":
+        raise ValueError("memory_budget plans the automatic topic sizes, so it needs n_topics='auto'")
+
     # determine embedding model
-    from sentence_transformers import SentenceTransformer, util
-    if embed_model == "miniLM":
-        embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
-    # specter as a model pretrained on academic abstracts
-    elif embed_model == "specter":
-        embedding_model = SentenceTransformer("allenai-specter")
-    else:
-        embedding_model = SentenceTransformer(embed_model)
+    name = EMBED_MODELS.get(embed_model, embed_model)
+    embedding_model = registered_model(("encoder", name, embed_backend),
+                                       partial(load_encoder, name, embed_backend))
+    if embed_backend != "torch":
+        sample = corpus['Abstract'].dropna()
+        sample = sample.sample(min(len(sample), 100), random_state=0).tolist()
+        reference = registered_model(("encoder", name, "torch"), partial(load_encoder, name))
+        check_embed_backend(embedding_model, reference, sample, backend_tolerance)
 
     # determine representation model
     if rep_model == "keybert":
-        representation_model = bertopic.representation.KeyBERTInspired()
+        representation_model = registered_model(("representation", rep_model),
+                                                bertopic.representation.KeyBERTInspired)
     # TODO - add in other representation models that can be used
 
-    # set topics and define model
+    # set topics (automatically calculate min topics and umap size, or bertopic's defaults
+    # when the number of topics is given)
+    plan = {"low_memory": False, "n_epochs": None, "min_samples": None}
     if n_topics == "auto":
-        # automatically calculate min topics and umap size
         min_topics, n_umap = hyperP_scaler(corpus)
+        if memory_budget is not None:
+            plan = resource_plan(corpus, memory_budget, embedding_model.get_sentence_embedding_dimension())
+            n_umap = plan["n_neighbors"]
+            pre_reduce = pre_reduce or plan["pre_reduce"]
+    else:
+        min_topics, n_umap = 10, 15
 
-        # specify UMAP implementation with or without seed (repeatability) using defaults
-        if seed != None:
-            from umap import UMAP
-            umap_model = UMAP(n_neighbors=n_umap, min_dist=0.0, metric='cosine',
-                      low_memory=False, random_state=seed)
-        else:
-            from umap import UMAP
-            umap_model = UMAP(n_neighbors=n_umap, min_dist=0.0, metric='cosine',
-                      low_memory=False)
+    # a seed makes UMAP single-threaded, so the fast mode leaves it unseeded on every core
+    if mode == "reproducible":
+        random_state, n_jobs = seed, 1
+    else:
+        random_state, n_jobs = None, -1
+    umap_model = UMAP(n_neighbors=n_umap, min_dist=0.0, metric='cosine', low_memory=plan["low_memory"],
+                      n_epochs=plan["n_epochs"], random_state=random_state, n_jobs=n_jobs)
+
+    # bertopic's default clustering, with fewer min_samples if planned
+    hdbscan_model = HDBSCAN(min_cluster_size=min_topics, min_samples=plan["min_samples"], metric='euclidean',
+                            cluster_selection_method='eom', prediction_data=True)
 
-        # final topic model
-        topic_model = bertopic.BERTopic(min_topic_size=min_topics,
+    # reduce large embeddings linearly before UMAP
+    if pre_reduce and pre_reduce < embedding_model.get_sentence_embedding_dimension():
+        umap_model = pre_reduction(umap_model, pre_reduce, random_state)
+
+    # define the topic model and hyperparameters
+    topic_model = bertopic.BERTopic(min_topic_size=min_topics,
+                                    nr_topics=None if n_topics == "auto" else n_topics,
                                     embedding_model=embedding_model,
                                     representation_model=representation_model,
-                                    umap_model=umap_model)
-    
-    # if topics are specified
+                                    umap_model=umap_model,
+                                    hdbscan_model=hdbscan_model)
+
+    return topic_model
+
+
+def encoder_backend(encoder):
+    '''
+    FUNCTION to find which of EMBED_BACKENDS a sentence transformer runs on
+    INPUT: a SentenceTransformer model
+    OUTPUT: "torch", "onnx" or "int8"
+    '''
+    import torch
+
+    # sentence-transformers before 3.2 has no backend attribute and only runs torch
+    if any(isinstance(module, torch.ao.nn.quantized.dynamic.Linear) for module in encoder.modules()):
+        return "int8"
+
+    return getattr(encoder, "backend", "torch")
+
+
+def embedding_model_id(encoder):
+    '''
+    FUNCTION to name the weights and settings of a sentence transformer (to key cached embeddings)
+    INPUT: a SentenceTransformer model
+    OUTPUT: a string identifying the model, its backend and its maximum sequence length
+    '''
+
+    # the full hub id or path, as different organisations (or folders) reuse model names
+    name = encoder[0].auto_model.config.name_or_path.rstrip('/')
+
+    # embeddings from the onnx and int8 backends differ slightly from the fp32 model's
+    backend = encoder_backend(encoder)
+
+    return f"{name}_{encoder.max_seq_length}" if backend == "torch" else f"{name}_{backend}_{encoder.max_seq_length}"
+
+
+# the sentence transformer loaded in each encoding worker process (see encode_documents)
+WORKER_ENCODER = {}
+
+
+def init_encoder_worker(encoder, n_threads):
+    '''
+    FUNCTION to set up an encoding worker process
+    INPUT: a SentenceTransformer model, or the model name, backend and maximum sequence length
+    to load one with (see load_encoder), and the number of torch threads for the worker
+    OUTPUT: none - the model is kept in WORKER_ENCODER
+    '''
+    import torch
+
+    # split the cores between the workers rather than every worker using all of them
+    torch.set_num_threads(n_threads)
+
+    if isinstance(encoder, tuple):
+        name, embed_backend, max_seq_length = encoder
+        encoder = load_encoder(name, embed_backend)
+        encoder.max_seq_length = max_seq_length
+    WORKER_ENCODER['model'] = encoder
+
+
+def encode_batches(encoder, texts, batch_size=32):
+    '''
+    FUNCTION to encode length sorted texts one batch at a time, so each batch only pads to
+    its own longest text (encode would otherwise re-sort them by character length)
+    INPUT: a SentenceTransformer model, a list of texts and the encoding batch size
+    OUTPUT: an array of embeddings
+    '''
+    import numpy as np
+
+    return np.concatenate([encoder.encode(texts[i:i + batch_size], batch_size=batch_size)
+                           for i in range(0, len(texts), batch_size)]).astype(np.float32, copy=False)
+
+
+def encode_shard(texts, batch_size=32):
+    '''
+    FUNCTION to encode a shard of texts in an encoding worker process
+    INPUT: a list of texts and the encoding batch size
+    OUTPUT: an array of embeddings
+    '''
+    return encode_batches(WORKER_ENCODER['model'], texts, batch_size)
+
+
+def token_lengths(texts, encoder):
+    '''
+    FUNCTION to count the tokens the encoder will see for each text
+    INPUT: a list of texts and a SentenceTransformer model
+    OUTPUT: an array of token counts (capped at the model's max_seq_length)
+    '''
+    import numpy as np
+
+    tokens = encoder.tokenizer(texts, add_special_tokens=True, truncation=False,
+                               return_attention_mask=False, verbose=False)['input_ids']
+    return np.minimum([len(ids) for ids in tokens], encoder.max_seq_length)
+
+
+def encode_documents(texts, encoder, batch_size=32, n_workers=1):
+    '''
+    FUNCTION to encode texts with a sentence transformer, optionally across a pool of CPU
+    worker processes. For the pool, texts are sorted by token length and cut into shards of
+    batches of similar length (which the workers take in turn), and the results are gathered
+    back into one array in the original order - a single process leaves the batching to encode
+    INPUT: a list of texts, a SentenceTransformer model, the encoding batch size and the
+    number of worker processes (None for one per core)
+    OUTPUT: an array of embeddings (one row per text, in the original order)
+    '''
+    import multiprocessing
+    import os
+    import time
+    import numpy as np
+    from concurrent.futures import ProcessPoolExecutor
+
+    start = time.perf_counter()
+    n_workers = n_workers or os.cpu_count()
+
+    if n_workers == 1:
+        # encode already sorts the texts by length within the call
+        embeddings = encoder.encode(texts, batch_size=batch_size).astype(np.float32, copy=False)
+    else:
+        # longest texts first so the slowest shards start early
+        order = np.argsort(-token_lengths(texts, encoder), kind='stable')
+        shard_size = batch_size * 8
+        shards = [order[i:i + shard_size] for i in range(0, len(texts), shard_size)]
+
+        # models loaded by topic_model are loaded again in each worker from their name rather
+        # than pickled there (onnx and int8 models can't be pickled, and it saves copying the weights)
+        spec = next(((key[1], key[2], encoder.max_seq_length) for key, model in MODEL_REGISTRY.items()
+                     if key[0] == "encoder" and model is encoder), None)
+        if spec is None and encoder_backend(encoder) != "torch":
+            raise ValueError(f"{encoder_backend(encoder)} models can only be shared with worker processes "
+                             f"when loaded by topic_model - use n_workers=1 or embed_backend='torch'")
+
+        # spawn rather than fork as torch is not fork safe
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=init_encoder_worker,
+                                 initargs=(spec or encoder, max(1, os.cpu_count() // n_workers))) as pool:
+            results = pool.map(encode_shard, [[texts[i] for i in shard] for shard in shards],
+                               [batch_size] * len(shards))
+
+            # gather the shards back into the original order
+            embeddings = None
+            for shard, result in zip(shards, results):
+                if embeddings is None:
+                    embeddings = np.empty((len(texts), result.shape[1]), dtype=np.float32)
+                embeddings[shard] = result
+
+    elapsed = time.perf_counter() - start
+    print(f"Encoded {len(texts)} documents in {elapsed:.1f}s ({len(texts) / elapsed:.0f} docs/second, {n_workers} worker(s))")
+
+    return embeddings
+
+
+def cached_embeddings(texts, encoder, cache_dir, batch_size=32, n_workers=1):
+    '''
+    FUNCTION to embed texts, reusing embeddings stored in cache_dir and storing any new ones.
+    Embeddings are kept per model as an append-only float32 file (read memory-mapped) with
+    an index of the sha1 hash of each text
+    INPUT: a list of texts, a SentenceTransformer model, the cache directory and the encoding
+    batch size and number of worker processes (see encode_documents)
+    OUTPUT: an array of embeddings (one row per text)
+    '''
+    import glob
+    import hashlib
+    import os
+    import numpy as np
+
+    # readable but file-safe, with a hash so ids that only differ in punctuation stay apart
+    model_id = embedding_model_id(encoder)
+    model_id = re.sub(r'[^\w.-]+', '_', model_id) + '_' + hashlib.sha1(model_id.encode('utf-8')).hexdigest()[:10]
+    keys_file = os.path.join(cache_dir, model_id + '.keys.npy')
+
+    # hash every text and look up its row in the store (-1 if not embedded yet)
+    digests = np.array([hashlib.sha1(text.encode('utf-8')).digest() for text in texts], dtype='S20')
+    keys = np.load(keys_file) if os.path.isfile(keys_file) else np.empty(0, dtype='S20')
+    rows = pd.Index(keys).get_indexer(digests)
+
+    # embed each text that is not in the store yet (once, even if it appears more than once)
+    missing = np.flatnonzero(rows < 0)
+    new_keys, first = np.unique(digests[missing], return_index=True)
+    if len(new_keys) > 0:
+        new_vectors = encode_documents([texts[i] for i in missing[first]], encoder, batch_size, n_workers)
+        dim = new_vectors.shape[1]
+        os.makedirs(cache_dir, exist_ok=True)
+        vectors_file = os.path.join(cache_dir, f'{model_id}.{dim}.f32')
+
+        # append the new vectors (dropping anything left past the indexed rows by an interrupted write)
+        with open(vectors_file, 'ab') as out_file:
+            out_file.truncate(len(keys) * dim * 4)
+            out_file.write(new_vectors.tobytes())
+
+        # then extend the index
+        keys = np.concatenate([keys, new_keys])
+        with open(keys_file + '.tmp', 'wb') as out_file:
+            np.save(out_file, keys)
+        os.replace(keys_file + '.tmp', keys_file)
+        rows = pd.Index(keys).get_indexer(digests)
+    elif len(keys) > 0:
+        vectors_file = glob.glob(os.path.join(glob.escape(cache_dir), glob.escape(model_id) + '.*.f32'))[0]
+        dim = int(vectors_file.split('.')[-2])
     else:
+        return np.empty((0, 0), dtype=np.float32)
+
+    vectors = np.memmap(vectors_file, dtype=np.float32, mode='r', shape=(len(keys), dim))
+
+    return np.asarray(vectors[rows])
+
 
-        if seed != None:
-            from umap import UMAP
-            umap_model = UMAP(n_neighbors=15, min_dist=0.0, metric='cosine',
-                      low_memory=False, random_state=123) # default params
+def knn_graph(data, n_neighbors, metric="cosine", cache_dir=None, seed=None, n_trees=None, n_iters=None):
+    '''
+    FUNCTION to build the approximate nearest neighbour graph UMAP starts from with NN-descent,
+    in the form UMAP takes as precomputed_knn. Graphs are stored in cache_dir, keyed by the
+    data and metric, and a stored graph with at least n_neighbors neighbours is reused (UMAP
+    prunes it), so re-fits with a different min_dist or seed skip the search entirely
+    INPUT: the data UMAP is fitted on, the number of neighbours, the metric, the cache
+    directory (None to not store the graph), a seed, and the number of random projection
+    trees and NN-descent iterations (UMAP's defaults for the data size if None)
+    OUTPUT: a tuple of neighbour indices, distances and the search index (which UMAP uses to
+    transform new documents)
+    '''
+    import glob
+    import hashlib
+    import os
+    import joblib
+    import numpy as np
+    from pynndescent import NNDescent
+
+    data = np.ascontiguousarray(data, dtype=np.float32)
+    key = f"knn_{hashlib.sha1(data.view(np.uint8)).hexdigest()}_{metric}"
+
+    if cache_dir is not None:
+        stored = {int(path.rsplit('_', 1)[1][:-4]): path for path in glob.glob(os.path.join(cache_dir, key + '_*.pkl'))}
+        usable = [k for k in stored if k >= n_neighbors]
+        if usable:
+            return joblib.load(stored[min(usable)])
+
+    # the same defaults UMAP uses for its own search
+    n_trees = n_trees or min(64, 5 + int(round(data.shape[0] ** 0.5 / 20.0)))
+    n_iters = n_iters or max(5, int(round(np.log2(data.shape[0]))))
+    index = NNDescent(data, n_neighbors=n_neighbors, metric=metric, random_state=seed, n_trees=n_trees,
+                      n_iters=n_iters, max_candidates=60, low_memory=True, compressed=False)
+    graph = (*index.neighbor_graph, index)
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        path = os.path.join(cache_dir, f"{key}_{n_neighbors}.pkl")
+        joblib.dump(graph, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    return graph
+
+
+def document_embeddings(docs, topic_model, embed_cache=None, n_workers=1, batch_size=32, max_seq_length=None):
+    '''
+    FUNCTION to embed abstracts with a topic model's embedding model (see fit_topic_model for
+    the options)
+    INPUT: a series of abstracts, a topic model, the embedding cache directory (or None), the
+    number of worker processes, the encoding batch size and the maximum number of tokens (the
+    topic model keeps an encoder truncated to it, so later transform calls truncate the same
+    way, while other topic models sharing the registered encoder are left as they were)
+    OUTPUT: an array of embeddings (one row per abstract)
+    '''
+    from functools import partial
+
+    # BERTopic wraps the sentence transformer in a backend once it has been fitted
+    backend = topic_model.embedding_model if hasattr(topic_model.embedding_model, 'embedding_model') else topic_model
+    encoder = backend.embedding_model
+    if max_seq_length is not None and encoder.max_seq_length != max_seq_length:
+        shared = [key[:3] for key, model in MODEL_REGISTRY.items() if model is encoder]
+        if shared:
+            # a registered copy truncated to this length (keyed by it), loaded on first use
+            def load(name, embed_backend):
+                truncated = load_encoder(name, embed_backend)
+                truncated.max_seq_length = max_seq_length
+                return truncated
+
+            kind, name, embed_backend = shared[0]
+            encoder = registered_model((kind, name, embed_backend, max_seq_length),
+                                       partial(load, name, embed_backend))
+            backend.embedding_model = encoder
         else:
-            from umap import UMAP
-            umap_model = UMAP(n_neighbors=15, min_dist=0.0, metric='cosine',
-                      low_memory=False) # default params
+            encoder.max_seq_length = max_seq_length
 
-        # define the topic model and hyperparameters
-        topic_model = bertopic.BERTopic(nr_topics=n_topics,
-                                    embedding_model=embedding_model,
-                                    representation_model=representation_model)
+    if embed_cache is not None:
+        return cached_embeddings(docs.tolist(), encoder, embed_cache, batch_size, n_workers)
 
-    return topic_model
+    return encode_documents(docs.tolist(), encoder, batch_size, n_workers)
 
 
-def fit_topic_model(corpus, topic_model):
+def sample_rows(corpus, sample_size, strata=("Year", "Source")):
+    '''
+    FUNCTION to draw a stratified sample of a corpus (the same share of every stratum)
+    INPUT: a corpus, the sample size (a number of documents, or a fraction if below 1) and
+    the columns to stratify by
+    OUTPUT: a sorted array of exactly the requested number of sampled row positions
+    '''
+    import numpy as np
+
+    n = len(corpus)
+    n_sample = min(n, round(sample_size * n) if sample_size < 1 else int(sample_size))
+    groups = [corpus[column] for column in strata if column in corpus]
+
+    # stratum of every row
+    if groups:
+        codes = pd.Series(np.arange(n), index=corpus.index).groupby(groups, dropna=False, observed=True).ngroup().to_numpy()
+    else:
+        codes = np.zeros(n, dtype=np.int64)
+
+    # seeded so the same corpus always gives the same sample
+    rng = np.random.default_rng(0)
+
+    # rows per stratum by largest remainder, so small strata are not all rounded down to 0
+    # and the counts add up to the sample size (ties are broken at random)
+    quotas = np.bincount(codes) * n_sample / n
+    counts = np.floor(quotas).astype(np.int64)
+    order = np.lexsort((rng.random(len(quotas)), counts - quotas))
+    counts[order[:n_sample - counts.sum()]] += 1
+
+    # shuffle the rows, group them by stratum and keep the first count rows of each
+    shuffled = rng.permutation(n)
+    shuffled = shuffled[np.argsort(codes[shuffled], kind='stable')]
+    stratum = codes[shuffled]
+    rank = np.arange(n) - np.searchsorted(stratum, stratum)
+
+    return np.sort(shuffled[rank < counts[stratum]])
+
+
+def scale_to_sample(topic_model, n_docs, n_sample):
+    '''
+    FUNCTION to rescale the sizes hyperP_scaler chose for a whole corpus (min_topic_size and
+    n_neighbors) to a sample of it, as topic_model sizes them for the corpus it is given
+    INPUT: a topic model from topic_model, the corpus size and the sample size
+    OUTPUT: none - the topic model's clustering and UMAP settings are updated
+    '''
+    full_topics, full_umap = hyperP_scaler(range(n_docs))
+    sample_topics, sample_umap = hyperP_scaler(range(n_sample))
+
+    hdbscan_model = topic_model.hdbscan_model
+    if getattr(hdbscan_model, 'min_cluster_size', None) == full_topics:
+        hdbscan_model.min_cluster_size = topic_model.min_topic_size = sample_topics
+        if hdbscan_model.min_samples is not None:
+            hdbscan_model.min_samples = min(hdbscan_model.min_samples, sample_topics)
+
+    umap_model = topic_model.umap_model
+    umap_model = umap_model.steps[-1][1] if hasattr(umap_model, 'steps') else umap_model
+    if getattr(umap_model, 'n_neighbors', None) == full_umap:
+        umap_model.n_neighbors = sample_umap
+
+
+def assign_topics(topic_model, docs, embeddings, rows, n_jobs=1, batch_size=10000):
+    '''
+    FUNCTION to assign topics to the documents a topic model was not fitted on, in parallel
+    batches through the model's transform (with precomputed embeddings)
+    INPUT: a topic model fitted on the documents at rows, all the documents and their
+    embeddings, the fitted row positions, the number of threads and the batch size
+    OUTPUT: the topics and probabilities of the remaining documents and their row positions
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    import numpy as np
+
+    rest = np.setdiff1d(np.arange(len(docs)), rows)
+    batches = [rest[i:i + batch_size] for i in range(0, len(rest), batch_size)]
+
+    def transform(batch):
+        return topic_model.transform([docs[i] for i in batch], embeddings=embeddings[batch])
+
+    # the first batch runs alone as UMAP sets up its search index on the first transform
+    results = [transform(batches[0])]
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        results += list(pool.map(transform, batches[1:]))
+
+    topics = np.concatenate([np.asarray(batch_topics) for batch_topics, _ in results])
+    probabilities = np.concatenate([np.asarray(batch_probabilities) for _, batch_probabilities in results])
+
+    return topics, probabilities, rest
+
+
+def topic_agreement(topics, reference):
+    '''
+    FUNCTION to measure how closely two topic assignments of the same documents agree (e.g.
+    a sample-fitted model against a full fit)
+    INPUT: two lists of topics (one per document)
+    OUTPUT: a dictionary of the adjusted rand index and normalised mutual information
+    '''
+    from sklearn.metrics import adjusted_rand_score, normalized_mutual_info_score
+
+    agreement = {"ARI": adjusted_rand_score(reference, topics), "NMI": normalized_mutual_info_score(reference, topics)}
+    print(f"Topic agreement: ARI {agreement['ARI']:.3f}, NMI {agreement['NMI']:.3f}")
+
+    return agreement
+
+
+def fit_topic_model(corpus, topic_model, embed_cache=None, n_workers=1, batch_size=32, max_seq_length=None,
+                    knn_cache=None, sample_size=None, strata=("Year", "Source")):
     '''
     FUNCTION to fit a topic model to a corpus
-    INPUT: a corpus and a topic model specified by the topic_model function
+    INPUT: a corpus and a topic model specified by the topic_model function. If embed_cache
+    is a directory the abstracts are embedded through cached_embeddings so only abstracts
+    not seen before (by this embedding model) are encoded. n_workers > 1 (or None for one
+    per core) encodes the abstracts across a pool of processes in batches of batch_size.
+    max_seq_length truncates abstracts to that many tokens when embedding (the model's own
+    window by default, 512 tokens for specter). If knn_cache is a directory UMAP's nearest
+    neighbour graph is built with knn_graph and stored there, so re-fits on the same
+    abstracts reuse it. If sample_size is given (a number of abstracts or a fraction) the
+    model is fitted on a sample stratified by strata and the other abstracts are assigned
+    to its topics afterwards in n_workers parallel batches (see assign_topics)
     OUTPUT: a fitted topic model (with topics and probabilities)
     '''
+    import numpy as np
   
     corpus = corpus.dropna(subset=['Abstract'])
     docs = corpus['Abstract'] # use the abstracts as the text data (corpus)
 
-    topics, probabilities = topic_model.fit_transform(docs)
+    if (embed_cache is not None or n_workers != 1 or max_seq_length is not None or knn_cache is not None
+            or sample_size is not None):
+        embeddings = document_embeddings(docs, topic_model, embed_cache, n_workers, batch_size, max_seq_length)
+
+        # the abstracts the model is fitted on (all of them unless sampling)
+        rows = np.arange(len(docs))
+        if sample_size is not None and sample_size < len(docs):
+            rows = sample_rows(corpus, sample_size, strata)
+            scale_to_sample(topic_model, len(docs), len(rows))
+
+        if knn_cache is not None:
+            from sklearn.base import clone
+
+            # the graph is built on what UMAP sees, i.e. after any pre-reduction (see pre_reduction)
+            umap_model, umap_data = topic_model.umap_model, embeddings[rows]
+            if hasattr(umap_model, 'steps'):
+                umap_data = clone(umap_model.steps[0][1]).fit_transform(umap_data)
+                umap_model = umap_model.steps[-1][1]
+            umap_model.precomputed_knn = knn_graph(umap_data, umap_model.n_neighbors, umap_model.metric,
+                                                   knn_cache, umap_model.random_state)
+
+        topics, probabilities = topic_model.fit_transform(docs.iloc[rows], embeddings=embeddings[rows])
+
+        if len(rows) < len(docs):
+            import time
+
+            start = time.perf_counter()
+            rest_topics, rest_probabilities, rest = assign_topics(topic_model, docs.tolist(), embeddings, rows, n_workers)
+            print(f"Fitted on {len(rows)} of {len(docs)} abstracts and assigned the rest in "
+                  f"{time.perf_counter() - start:.1f}s")
+
+            # topics and probabilities for every abstract, in corpus order
+            all_topics = np.empty(len(docs), dtype=int)
+            all_topics[rows], all_topics[rest] = topics, rest_topics
+            all_probabilities = np.empty((len(docs),) + np.shape(probabilities)[1:])
+            all_probabilities[rows], all_probabilities[rest] = probabilities, rest_probabilities
+            topics, probabilities = all_topics.tolist(), all_probabilities
+
+            # rebuild the topic representations over the whole corpus with the model's own
+            # settings, as assigned abstracts can add topics (e.g. outliers) the sample fit
+            # did not have (drop_topics and reduce_topics need every topic described)
+            topic_model.update_topics(docs.tolist(), topics=topics, top_n_words=topic_model.top_n_words,
+                                      vectorizer_model=topic_model.vectorizer_model,
+                                      ctfidf_model=topic_model.ctfidf_model,
+                                      representation_model=topic_model.representation_model)
+            topic_model.probabilities_ = probabilities
+            # and the topic mapper (which reduce_topics maps through) needs to know the outliers
+            mappings = topic_model.topic_mapper_.mappings_
+            if -1 in topic_model.topic_sizes_ and -1 not in [mapping[0] for mapping in mappings]:
+                mappings.insert(0, [-1] * len(mappings[0]))
+
+            # topic embeddings as fit_transform makes them (the centroid of each topic's abstracts)
+            # rather than update_topics' weighted word embeddings
+            ids, codes = np.unique(topics, return_inverse=True)
+            centroids = np.zeros((len(ids), embeddings.shape[1]))
+            np.add.at(centroids, codes, embeddings)
+            topic_model.topic_embeddings_ = centroids / np.bincount(codes)[:, None]
+    else:
+        topics, probabilities = topic_model.fit_transform(docs)
 
     return corpus, topics, probabilities
 
 
+def tree_labels(hdbscan_model, min_cluster_size):
+    '''
+    FUNCTION to re-extract a flat clustering from a fitted HDBSCAN model's single-linkage tree
+    for another min_cluster_size, without clustering again. min_samples (which the tree
+    depends on) stays as fitted - when left unset it was the fitted min_cluster_size
+    INPUT: a fitted HDBSCAN model and a minimum cluster (topic) size
+    OUTPUT: an array of labels (one per clustered document, -1 for outliers)
+    '''
+    from hdbscan.hdbscan_ import _tree_to_labels
+
+    if getattr(hdbscan_model, '_single_linkage_tree', None) is None:
+        raise ValueError("The topic model needs a fitted HDBSCAN model to sweep min_topic_size")
+
+    # every selection option the model was fitted with (cluster_selection_epsilon_max is only
+    # in hdbscan 0.8.40 onwards)
+    options = {option: getattr(hdbscan_model, option) for option in
+               ("match_reference_implementation", "cluster_selection_epsilon", "max_cluster_size",
+                "cluster_selection_epsilon_max") if hasattr(hdbscan_model, option)}
+
+    labels = _tree_to_labels(None, hdbscan_model._single_linkage_tree, min_cluster_size,
+                             hdbscan_model.cluster_selection_method, hdbscan_model.allow_single_cluster,
+                             **options)[0]
+
+    return labels
+
+
+def condensed_clusters(hdbscan_model, min_cluster_size):
+    '''
+    FUNCTION to condense a fitted HDBSCAN model's single-linkage tree once into per-cluster
+    summaries (when each cluster is born, its size, its child clusters and running totals of
+    the points leaving it) from which the clustering for any larger min_cluster_size can be
+    found without revisiting the points (see cluster_counts)
+    INPUT: a fitted HDBSCAN model and the smallest minimum cluster size of interest
+    OUTPUT: a dictionary of cluster summaries
+    '''
+    import numpy as np
+    from hdbscan._hdbscan_tree import condense_tree
+
+    tree = condense_tree(hdbscan_model._single_linkage_tree, min_cluster_size)
+    # clusters are numbered from the number of points, starting with the root
+    root = int(tree['parent'].min())
+    births, sizes, children = {root: 0.0}, {root: root}, {}
+    for parent, child, birth, size in tree[tree['child'] >= root].tolist():
+        births[child], sizes[child] = birth, size
+        children.setdefault(parent, []).append((child, birth, size))
+
+    # the points leaving each cluster (in order) with running counts and sums of lambda
+    points = tree[tree['child'] < root]
+    points = points[np.lexsort((points['lambda_val'], points['parent']))]
+    ids, starts = np.unique(points['parent'], return_index=True)
+    leaving = {cluster: (lambdas, np.arange(1, len(lambdas) + 1), np.cumsum(lambdas))
+               for cluster, lambdas in zip(ids.tolist(), np.split(points['lambda_val'], starts[1:]))}
+
+    return {"root": root, "births": births, "sizes": sizes, "children": children, "leaving": leaving}
+
+
+def cluster_counts(clusters, min_cluster_size, method="eom"):
+    '''
+    FUNCTION to find the flat clustering HDBSCAN would select for a min_cluster_size (at least
+    the one the summaries were condensed with) - child clusters that are now too small become
+    points leaving their parent, and a cluster ends once too few of its points remain
+    INPUT: summaries from condensed_clusters, a minimum cluster size and the cluster selection
+    method ("eom" or "leaf")
+    OUTPUT: the number of clusters and the number of clustered (non-outlier) points
+    '''
+    import numpy as np
+
+    root, births, sizes = clusters["root"], clusters["births"], clusters["sizes"]
+    no_points = (np.empty(0), np.empty(0, dtype=int), np.empty(0))
+
+    # follow each cluster down to where it splits or ends, noting its stability
+    kept, stack = {}, [root]
+    while stack:
+        start = node = stack.pop()
+        exits, split = 0.0, []
+        while True:
+            lambdas, gone, lambda_sums = clusters["leaving"].get(node, no_points)
+            end = np.searchsorted(gone, sizes[node] - min_cluster_size, side='right')
+            if end < len(lambdas):
+                # the points still in the cluster all leave when it ends
+                before = (lambda_sums[end - 1], gone[end - 1]) if end else (0.0, 0)
+                exits += before[0] + (sizes[node] - before[1]) * lambdas[end]
+                break
+            exits += lambda_sums[-1] if len(lambdas) else 0.0
+            large = [child for child in clusters["children"].get(node, []) if child[2] >= min_cluster_size]
+            exits += sum(birth * size for child, birth, size in clusters["children"].get(node, []))
+            if len(large) == 1:
+                # the cluster carries on as its only child that is large enough
+                node = large[0][0]
+                exits -= large[0][1] * large[0][2]
+                continue
+            if len(large) == 2:
+                split = [child for child, birth, size in large]
+                stack.extend(split)
+            break
+        kept[start] = (exits - births[start] * sizes[start], split)
+
+    if method == "leaf":
+        selected = [cluster for cluster, (stability, split) in kept.items() if not split and cluster != root]
+    else:
+        # excess of mass, children before parents (ids grow down the tree) and summing in
+        # single precision as hdbscan does so near-ties resolve the same way
+        values, picks = {}, {}
+        for cluster in sorted(kept, reverse=True):
+            stability, split = kept[cluster]
+            subtree = np.float32(0)
+            for child in split:
+                subtree = np.float32(subtree + values[child])
+            if split and (subtree > stability or cluster == root):
+                values[cluster], picks[cluster] = subtree, [pick for child in split for pick in picks[child]]
+            else:
+                values[cluster], picks[cluster] = stability, [cluster]
+        selected = picks[root] if kept[root][1] else []
+
+    return len(selected), sum(sizes[cluster] for cluster in selected)
+
+
+def min_topic_sweep(model, sizes=None):
+    '''
+    FUNCTION to compare min_topic_size settings for a fitted topic model by condensing the
+    HDBSCAN tree once and re-extracting topics from it (milliseconds per setting) rather than
+    refitting BERTopic. A chosen setting can be applied with
+    model.update_topics(docs, topics=tree_labels(model.hdbscan_model, size))
+    INPUT: a fitted topic model and a list of min_topic_size values (by default half to four
+    times the fitted one)
+    OUTPUT: a dataframe with the number of topics and share of outliers (among the abstracts
+    the model was fitted on) for each setting
+    '''
+    import time
+
+    hdbscan_model = model.hdbscan_model
+    if getattr(hdbscan_model, '_single_linkage_tree', None) is None:
+        raise ValueError("The topic model needs a fitted HDBSCAN model to sweep min_topic_size")
+
+    if sizes is None:
+        fitted = hdbscan_model.min_cluster_size
+        sizes = sorted({max(int(fitted * factor), 2) for factor in (0.5, 0.75, 1, 1.5, 2, 3, 4)})
+
+    # options the summaries don't cover fall back to extracting full labellings, as do
+    # duplicate points (merged at distance 0, so at an infinite lambda whose stability
+    # hdbscan handles specially)
+    exact = ((hdbscan_model._single_linkage_tree[:, 2] == 0).any()
+             or hdbscan_model.cluster_selection_epsilon or hdbscan_model.allow_single_cluster
+             or getattr(hdbscan_model, 'max_cluster_size', 0)
+             or getattr(hdbscan_model, 'cluster_selection_epsilon_max', float('inf')) != float('inf')
+             or getattr(hdbscan_model, 'match_reference_implementation', False))
+    start = time.perf_counter()
+    clusters = None if exact else condensed_clusters(hdbscan_model, min(sizes))
+    condensed = time.perf_counter()
+    rows = []
+    for size in sizes:
+        if exact:
+            labels = tree_labels(hdbscan_model, size)
+            n_topics, n_clustered, n_docs = len(set(labels) - {-1}), (labels != -1).sum(), len(labels)
+        else:
+            n_topics, n_clustered = cluster_counts(clusters, size, hdbscan_model.cluster_selection_method)
+            n_docs = clusters["root"]
+        rows.append({"min_topic_size": size, "Topics": n_topics, "Outliers": 1 - n_clustered / n_docs})
+    print(f"Condensed the topic tree in {(condensed - start) * 1000:.0f}ms and swept {len(sizes)} "
+          f"min_topic_size settings in {(time.perf_counter() - condensed) * 1000:.0f}ms")
+
+    return pd.DataFrame(rows)
+
+
+def online_topic_model(embed_model="miniLM", n_topics=50, n_components=50, decay=0.01, seed=123,
+                       embed_backend="torch"):
+    '''
+    FUNCTION to specify a topic model that is updated with new batches of abstracts (see
+    partial_fit_topic_model) rather than refitted - incremental PCA of the embeddings scaled
+    to unit length in place of UMAP, mini-batch k-means in place of HDBSCAN (so there are no
+    outliers) and a vectoriser whose vocabulary grows with the corpus. Topics are described
+    by c-TF-IDF alone as KeyBERT would re-embed every topic's words on every batch
+    INPUT: the embedding model and backend (as in topic_model), the number of topics, the
+    number of dimensions to reduce the embeddings to, how much older word counts decay with
+    each batch and a seed
+    OUTPUT: a specified topic model
+    '''
+    from functools import partial
+    import bertopic
+    from bertopic.vectorizers import OnlineCountVectorizer
+    from sklearn.cluster import MiniBatchKMeans
+    from sklearn.decomposition import IncrementalPCA
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import Normalizer
+
+    name = EMBED_MODELS.get(embed_model, embed_model)
+    embedding_model = registered_model(("encoder", name, embed_backend),
+                                       partial(load_encoder, name, embed_backend))
+
+    # unit length so k-means compares abstracts by cosine as UMAP does, part of the reduction
+    # so every later transform scales embeddings the same way
+    reducer = Pipeline([("normalise", Normalizer()), ("pca", IncrementalPCA(n_components=n_components))])
+
+    topic_model = bertopic.BERTopic(embedding_model=embedding_model,
+                                    umap_model=reducer,
+                                    hdbscan_model=MiniBatchKMeans(n_clusters=n_topics, random_state=seed, n_init=3),
+                                    vectorizer_model=OnlineCountVectorizer(decay=decay))
+
+    return topic_model
+
+
+def partial_fit_topic_model(corpus, topic_model, embed_cache=None, n_workers=1, batch_size=32, passes=5,
+                            reduce_until=5000):
+    '''
+    FUNCTION to fold a new batch of abstracts into a topic model from online_topic_model.
+    Topic ids stay the same across batches (new clusters get new ids) and the time taken
+    for the batch is reported. The reduction stops learning once it has seen enough
+    abstracts, as every update rotates the space the k-means centres live in
+    INPUT: a corpus (the new records, the first batch needing at least as many abstracts as
+    topics), a topic model, the embedding options of fit_topic_model, the number of k-means
+    passes over the batch and the number of abstracts after which the reduction is frozen
+    OUTPUT: the batch (with abstracts) and its topics
+    '''
+    import time
+    from sklearn.preprocessing import FunctionTransformer
+
+    corpus = corpus.dropna(subset=['Abstract'])
+    docs = corpus['Abstract']
+    reducer, clusterer = topic_model.umap_model, topic_model.hdbscan_model
+
+    if topic_model.topic_sizes_ is None and len(docs) < clusterer.n_clusters:
+        raise ValueError(f"The first batch needs at least {clusterer.n_clusters} abstracts")
+
+    start = time.perf_counter()
+    # float64 as k-means keeps the dtype of the first batch
+    embeddings = document_embeddings(docs, topic_model, embed_cache, n_workers, batch_size).astype('float64')
+
+    # the pipeline has no partial_fit so its pca is updated directly
+    pca = reducer.named_steps["pca"]
+    if getattr(pca, 'n_samples_seen_', 0) < reduce_until:
+        pca.partial_fit(reducer.named_steps["normalise"].transform(embeddings))
+    reduced = reducer.transform(embeddings)
+    # a single partial_fit is one mini-batch step so the centres get a few passes first
+    for _ in range(passes):
+        for i in range(0, len(reduced), clusterer.batch_size):
+            clusterer.partial_fit(reduced[i:i + clusterer.batch_size])
+
+    # BERTopic would update the reduction again so it only gets its transform for this batch
+    topic_model.umap_model = FunctionTransformer(reducer.transform)
+    try:
+        topic_model.partial_fit(docs.tolist(), embeddings=embeddings)
+    finally:
+        topic_model.umap_model = reducer
+    topics = topic_model.topics_
+
+    print(f"Folded in {len(docs)} abstracts in {time.perf_counter() - start:.1f}s "
+          f"({len(set(topics))} topics in the batch, {len(topic_model.topic_sizes_)} in total)")
+
+    return corpus, topics
+
+
 def drop_topics(corpus, model, n_topics='auto'):
     '''
     FUNCTION to reduce the size of the topic model (k - number of topics)
@@ -372,6 +1884,8 @@ def create_wordcloud(model, topic):
     INPUT: a model and specific topic to visulaise
     OUTPUT: a wordcloud for the topic
     '''
+    from wordcloud import WordCloud
+    import matplotlib.pyplot as plt
     
     text = {word: value for word, value in model.get_topic(topic)}
     wc = WordCloud(background_color="white", max_words=1000)
@@ -381,12 +1895,16 @@ def create_wordcloud(model, topic):
     return plt
 
 
-def topic_report(model, corpus):
+def topic_report(model, corpus, topic_distr=None):
     '''
     FUNCTION to create the topic report for a model
-    INPUT: a corpus and a model
+    INPUT: a corpus and a model (and optionally the topic distribution of the corpus if
+    it has already been approximated)
     OUTPUT: a full topic report as PDF
     '''
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.utils import ImageReader
     
     # specify number of pages as the number of topics
     end_page = len(model.topic_labels_)-1 # ignore outlier topic
@@ -402,8 +1920,9 @@ def topic_report(model, corpus):
     w, h = A4
 
     # create combined df
-    docs = corpus['Abstract']
-    topic_distr, _ = model.approximate_distribution(docs)
+    if topic_distr is None:
+        docs = corpus['Abstract']
+        topic_distr, _ = model.approximate_distribution(docs)
     # extract the labels for each topic
     col_names = [*model.topic_labels_.values()]
     # build a dataframe of topic proportions (row as records, columns as topics)
@@ -442,7 +1961,7 @@ def topic_report(model, corpus):
         col_name = list(model.topic_labels_.values())[i+1]
         journals_temp = output[["Source", col_name]]
         # sum up the number of citations per source and sort
-        journals = journals_temp.groupby(["Source"]).sum().reset_index()
+        journals = journals_temp.groupby(["Source"], observed=True).sum().reset_index()
         journals = journals.sort_values(by=[col_name], ascending=False)
         text.setFont('Helvetica-Bold', 10)
         text.textLine("Top Sources")
@@ -498,13 +2017,19 @@ def topic_report(model, corpus):
     c.save()
 
 
-def topic_outputs(corpus, model, topics, viz="all", save=True, nbook="colab"):
+def topic_outputs(corpus, model, topics, viz="all", save=True, nbook="colab", export_jobs=1, n_renderers=1):
     '''
     FUNCTION to create visualisations of the topic outputs
-    INPUT: a corpus and topic model
+    INPUT: a corpus and topic model and the visualisation(s) to produce
+    ("all", one name or a list of names from TOPIC_ARTEFACTS). export_jobs and n_renderers
+    set the threads and image renderers used to write the outputs (see export_outputs), which
+    is worth raising for a large similarity_matrix
     OUTPUT: one or more visualisation(s) potentially saved as a folder 
     '''
 
+    # only the requested artefacts are computed
+    selected = select_artefacts(viz, TOPIC_ARTEFACTS)
+
     if nbook == "colab" and save:
         import os
         if os.path.isdir('/content/output'):
@@ -523,43 +2048,34 @@ def topic_outputs(corpus, model, topics, viz="all", save=True, nbook="colab"):
         os.chdir("/output")
 
     return_dict = {} # empty dictionary to return visualisation
+    tables = {} # tables to save alongside the visualisations
 
     # Distance map
-    if viz == "all" or "distance_map":
+    if "distance_map" in selected:
         fig = model.visualize_topics()
 
         return_dict["distance_map"] = fig
 
-        if save:
-            fig.write_image("distance_map.png")
-            fig.write_html("distance_map.html")
-
     # Topic barcharts
-    if viz == "all" or "topic_bar":
+    if "topic_bar" in selected:
         # subtract 1 to remove the outliers
         fig = model.visualize_barchart(top_n_topics=len(model.topic_labels_)-1)
 
         return_dict["topic_bar"] = fig
 
-        if save:
-            fig.write_image("topic_bar.png")
-            fig.write_html("topic_bar.html")
-
     # Similiarity matrix
-    if viz == "all" or "similarity_matrix":
+    if "similarity_matrix" in selected:
         fig = model.visualize_heatmap()
 
         return_dict["similarity_matrix"] = fig
 
-        if save:
-            fig.write_image("similarity_matrix.png")
-            fig.write_html("similarity_matrix.html")
-
-    # Topic dataframe
-    if viz == "all" or "topics_df":
+    # topic distribution shared by the topic dataframe and report
+    if selected & {"topics_df", "topic_report"}:
         docs = corpus['Abstract']
         topic_distr, _ = model.approximate_distribution(docs)
 
+    # Topic dataframe
+    if "topics_df" in selected:
         # extract the labels for each topic
         col_names = [*model.topic_labels_.values()]
 
@@ -568,10 +2084,13 @@ def topic_outputs(corpus, model, topics, viz="all", save=True, nbook="colab"):
 
         output = pd.concat([corpus.reset_index(drop=True), topics_df.reset_index(drop=True)], axis=1) # axis 1 means adding as columns (to the right)
 
-        output.to_csv("topics_df.csv", index=False)
+        tables["topics_df"] = output
+
+    if "topic_report" in selected:
+        topic_report(model, corpus, topic_distr)
 
-    if viz == "all" or "topic_report":
-        topic_report(model, corpus)
+    # write all of the outputs together (the topic dataframe is written even if save == False)
+    export_outputs(return_dict if save else {}, tables, n_renderers=n_renderers, n_jobs=export_jobs)
 
     # return everything
     return return_dict